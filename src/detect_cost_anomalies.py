@@ -4,6 +4,7 @@ Detect GCP cost anomalies from BigQuery billing export and
 optionally post to Slack and create a GitHub issue.
 Env vars:
   BILLING_TABLE (required) e.g. "project.dataset.table"
+    (or set PROJECT_ID, DATASET_ID and TABLE_ID separately)
   THRESHOLD_PERCENT (optional, default 30)
   BASELINE_DAYS (optional, default 7)
   MIN_ABSOLUTE_INCREASE (optional, default 5.0)  # $ trigger for zero baseline
@@ -14,16 +15,26 @@ Env vars:
 """
 import os
 import json
+import asyncio
+import argparse
 import logging
-from datetime import datetime, timedelta
-import requests
-from google.cloud import bigquery
+import functools
+from datetime import datetime, timedelta, timezone
+import httpx
+import numpy as np
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
-BILLING_TABLE = os.getenv("BILLING_TABLE")
-if not BILLING_TABLE:
-    raise SystemExit("BILLING_TABLE environment variable is required (project.dataset.table)")
+def _billing_table():
+    table = os.getenv("BILLING_TABLE")
+    if table:
+        return table
+    project, dataset, table_id = os.getenv("PROJECT_ID"), os.getenv("DATASET_ID"), os.getenv("TABLE_ID")
+    if project and dataset and table_id:
+        return f"{project}.{dataset}.{table_id}"
+    return None
+
+BILLING_TABLE = _billing_table()
 
 THRESHOLD_PERCENT = float(os.getenv("THRESHOLD_PERCENT", "30"))
 BASELINE_DAYS = int(os.getenv("BASELINE_DAYS", "7"))
@@ -33,80 +44,122 @@ CREATE_ISSUE = os.getenv("CREATE_GITHUB_ISSUE", "false").lower() == "true"
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_REPOSITORY = os.getenv("GITHUB_REPOSITORY")  # owner/repo
 
-client = bigquery.Client()
+# The google-cloud imports and client construction are deferred so that
+# importing the module (and --test runs) never triggers ADC credential
+# discovery or metadata-server lookups.
+@functools.lru_cache(maxsize=1)
+def _get_client():
+    from google.cloud import bigquery
+    return bigquery.Client()
 
-def run_query(yesterday, baseline_days):
-    start_baseline = (yesterday - timedelta(days=baseline_days)).isoformat()
-    y_date = yesterday.isoformat()
+@functools.lru_cache(maxsize=1)
+def _get_bqstorage_client():
+    # Reused across queries: the Storage Read API streams Arrow batches over
+    # gRPC, avoiding the row-at-a-time tabledata.list path.
+    from google.cloud import bigquery_storage
+    return bigquery_storage.BigQueryReadClient()
 
-    query = f"""
-    WITH baseline AS (
-      SELECT service.description AS service, SUM(cost) AS baseline_total
-      FROM `{BILLING_TABLE}`
-      WHERE DATE(usage_start_time) >= DATE('{start_baseline}')
-        AND DATE(usage_start_time) < DATE('{y_date}')
+# Module-level template: with dates and thresholds bound as parameters, the
+# submitted SQL text is byte-identical across runs, so BigQuery can reuse its
+# parsed plan (and the result cache where applicable).
+SQL_TEMPLATE = """
+    WITH per_service AS (
+      SELECT service.description AS service,
+             SUM(IF(DATE(usage_start_time) = @y, cost, 0)) AS recent_cost,
+             SUM(IF(DATE(usage_start_time) BETWEEN DATE_SUB(@y, INTERVAL @baseline_days DAY)
+                                              AND DATE_SUB(@y, INTERVAL 1 DAY),
+                    cost, 0)) AS baseline_total
+      FROM `{table}`
+      WHERE _PARTITIONDATE BETWEEN DATE_SUB(@y, INTERVAL @baseline_days DAY)
+                               AND DATE_ADD(@y, INTERVAL 1 DAY)
+        AND usage_start_time >= TIMESTAMP(DATE_SUB(@y, INTERVAL @baseline_days DAY))
+        AND usage_start_time < TIMESTAMP(DATE_ADD(@y, INTERVAL 1 DAY))
       GROUP BY service
+      HAVING recent_cost > 0
     ),
-    recent AS (
-      SELECT service.description AS service, SUM(cost) AS recent_cost
-      FROM `{BILLING_TABLE}`
-      WHERE DATE(usage_start_time) = DATE('{y_date}')
-      GROUP BY service
+    joined AS (
+      SELECT service, recent_cost,
+             COALESCE(SAFE_DIVIDE(baseline_total, @baseline_days), 0) AS baseline_avg
+      FROM per_service
     )
-    SELECT r.service, r.recent_cost, COALESCE(b.baseline_total, 0) AS baseline_total
-    FROM recent r
-    LEFT JOIN baseline b USING(service)
-    ORDER BY r.recent_cost DESC
-    """
-    logging.info("Running BigQuery query for %s (baseline_days=%d)", y_date, baseline_days)
-    job = client.query(query)
-    return list(job.result())
-
-def detect_anomalies(rows, baseline_days, threshold_pct, min_abs):
+    SELECT service, recent_cost, baseline_avg,
+           IF(baseline_avg > 0,
+              SAFE_DIVIDE(recent_cost - baseline_avg, baseline_avg) * 100.0,
+              NULL) AS percent_change
+    FROM joined
+    WHERE (baseline_avg > 0
+           AND SAFE_DIVIDE(recent_cost - baseline_avg, baseline_avg) * 100.0 > @threshold_pct)
+       OR (baseline_avg <= 0 AND recent_cost >= @min_abs)
+    ORDER BY recent_cost DESC
+"""
+
+@functools.lru_cache(maxsize=1)
+def _render_sql():
+    return SQL_TEMPLATE.format(table=BILLING_TABLE)
+
+def run_query(yesterday, baseline_days, threshold_pct, min_abs):
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("y", "DATE", yesterday),
+            bigquery.ScalarQueryParameter("baseline_days", "INT64", baseline_days),
+            bigquery.ScalarQueryParameter("threshold_pct", "FLOAT64", threshold_pct),
+            bigquery.ScalarQueryParameter("min_abs", "FLOAT64", min_abs),
+        ],
+        use_query_cache=True,
+        maximum_bytes_billed=10 * 1024**3,  # hard stop at 10 GiB if pruning ever regresses
+    )
+    logging.info("Running BigQuery query for %s (baseline_days=%d)", yesterday, baseline_days)
+    job = _get_client().query(_render_sql(), job_config=job_config)
+    return job.result().to_dataframe(bqstorage_client=_get_bqstorage_client())
+
+def detect_anomalies(df, threshold_pct, min_abs):
+    # Filtering happens server-side in run_query; the rows we get back are
+    # already the anomalies, so this just shapes them for reporting.
     anomalies = []
-    for row in rows:
-        service = row["service"]
-        recent_cost = float(row["recent_cost"] or 0.0)
-        baseline_total = float(row["baseline_total"] or 0.0)
-        baseline_avg = baseline_total / baseline_days if baseline_days > 0 else 0.0
-
-        if baseline_avg <= 0:
-            # No baseline activity — treat as anomaly if recent exceeds absolute threshold
-            if recent_cost >= min_abs:
-                anomalies.append({
-                    "service": service,
-                    "recent_cost": recent_cost,
-                    "baseline_avg": baseline_avg,
-                    "percent_change": None,
-                    "reason": f"no baseline; recent >= ${min_abs:.2f}"
-                })
-        else:
-            pct_change = (recent_cost - baseline_avg) / baseline_avg * 100.0
-            if pct_change > threshold_pct:
-                anomalies.append({
-                    "service": service,
-                    "recent_cost": recent_cost,
-                    "baseline_avg": baseline_avg,
-                    "percent_change": pct_change,
-                    "reason": f">{threshold_pct}%"
-                })
+    for row in df.itertuples(index=False):
+        has_pct = row.percent_change is not None and not np.isnan(row.percent_change)
+        anomalies.append({
+            "service": row.service,
+            "recent_cost": float(row.recent_cost),
+            "baseline_avg": float(row.baseline_avg),
+            "percent_change": float(row.percent_change) if has_pct else None,
+            "reason": f">{threshold_pct}%" if has_pct else f"no baseline; recent >= ${min_abs:.2f}"
+        })
     return anomalies
 
-def post_to_slack(text):
+# Statuses worth retrying: Slack rate limits at ~1 RPS (429) and both APIs
+# can return transient 5xx.
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+async def _post_with_retry(client, url, retries=3, backoff=0.3, **kwargs):
+    for attempt in range(retries + 1):
+        r = await client.post(url, **kwargs)
+        if r.status_code not in RETRYABLE_STATUSES or attempt == retries:
+            r.raise_for_status()
+            return r
+        retry_after = r.headers.get("Retry-After")
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else backoff * 2 ** attempt
+        logging.warning("POST %s returned %d — retrying in %.1fs", url, r.status_code, delay)
+        await asyncio.sleep(delay)
+
+async def post_to_slack(client, chunks):
     if not SLACK_WEBHOOK:
         logging.warning("SLACK_WEBHOOK_URL not set — skipping Slack post.")
         return False
-    payload = {"text": text}
     try:
-        r = requests.post(SLACK_WEBHOOK, json=payload, timeout=10)
-        r.raise_for_status()
-        logging.info("Slack notification sent.")
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(1.05)  # webhooks allow ~1 request per second
+            await _post_with_retry(client, SLACK_WEBHOOK, json={"text": chunk})
+        logging.info("Slack notification sent (%d message(s)).", len(chunks))
         return True
     except Exception as e:
         logging.error("Failed to send Slack message: %s", e)
         return False
 
-def create_github_issue(title, body):
+async def create_github_issue(client, title, body):
     if not GITHUB_TOKEN or not GITHUB_REPOSITORY:
         logging.warning("GITHUB_TOKEN or GITHUB_REPOSITORY not set — skipping issue creation.")
         return False
@@ -117,40 +170,95 @@ def create_github_issue(title, body):
     }
     payload = {"title": title, "body": body}
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=10)
-        r.raise_for_status()
+        r = await _post_with_retry(client, url, headers=headers, json=payload)
         logging.info("GitHub issue created: %s", r.json().get("html_url"))
         return True
     except Exception as e:
         logging.error("Failed to create GitHub issue: %s", e)
         return False
 
+# Keep each Slack message well under the 40 KB webhook payload limit.
+SLACK_CHUNK_CHARS = 3800
+
+# Hoisted out of format_message so the per-anomaly loop is one .format() call.
+ANOMALY_TEMPLATE = (
+    "*Service:* {service}\n"
+    "  - Recent: ${recent_cost:.2f}\n"
+    "  - Baseline avg/day: ${baseline_avg:.2f}\n"
+    "  - Change: {pct}\n"
+    "  - Note: {reason}\n"
+)
+
 def format_message(anomalies, y_date):
-    lines = [f"*GCP Cost Anomalies for {y_date}* — {len(anomalies)} found\n"]
-    for a in anomalies:
-        pct = f"{a['percent_change']:.1f}%" if a['percent_change'] is not None else "N/A"
-        lines.append(f"*Service:* {a['service']}\n  - Recent: ${a['recent_cost']:.2f}\n  - Baseline avg/day: ${a['baseline_avg']:.2f}\n  - Change: {pct}\n  - Note: {a['reason']}\n")
-    return "\n".join(lines)
+    """Format anomalies into a list of Slack-sized message chunks."""
+    blocks = [
+        ANOMALY_TEMPLATE.format(
+            pct=f"{a['percent_change']:.1f}%" if a["percent_change"] is not None else "N/A", **a
+        )
+        for a in anomalies
+    ]
+    header = f"*GCP Cost Anomalies for {y_date}* — {len(anomalies)} found\n"
+    chunks, lines, size = [], [header], len(header)
+    for block in blocks:
+        if size + len(block) + 1 > SLACK_CHUNK_CHARS and lines:
+            chunks.append("\n".join(lines))
+            lines, size = [], 0
+        lines.append(block)
+        size += len(block) + 1
+    if lines:
+        chunks.append("\n".join(lines))
+    return chunks
 
-def main():
-    yesterday = (datetime.utcnow().date() - timedelta(days=1))
-    rows = run_query(yesterday, BASELINE_DAYS)
-    anomalies = detect_anomalies(rows, BASELINE_DAYS, THRESHOLD_PERCENT, MIN_ABSOLUTE_INCREASE)
+def _sample_anomalies():
+    # Stand-in rows for --test runs, covering both anomaly reasons.
+    return [
+        {"service": "Compute Engine", "recent_cost": 42.00, "baseline_avg": 20.00,
+         "percent_change": 110.0, "reason": f">{THRESHOLD_PERCENT}%"},
+        {"service": "Cloud Storage", "recent_cost": 7.50, "baseline_avg": 0.0,
+         "percent_change": None, "reason": f"no baseline; recent >= ${MIN_ABSOLUTE_INCREASE:.2f}"},
+    ]
+
+async def main(test=False):
+    yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+    y_iso = yesterday.isoformat()
+
+    if test:
+        chunks = format_message(_sample_anomalies(), y_iso)
+        logging.info("Test mode — sample report (nothing queried or posted):\n%s", "\n".join(chunks))
+        return
+
+    if not BILLING_TABLE:
+        raise SystemExit("BILLING_TABLE environment variable is required (project.dataset.table)")
+
+    df = run_query(yesterday, BASELINE_DAYS, THRESHOLD_PERCENT, MIN_ABSOLUTE_INCREASE)
+    anomalies = detect_anomalies(df, THRESHOLD_PERCENT, MIN_ABSOLUTE_INCREASE)
 
     if not anomalies:
-        logging.info("No anomalies detected for %s", yesterday.isoformat())
+        logging.info("No anomalies detected for %s", y_iso)
         return
 
-    message = format_message(anomalies, yesterday.isoformat())
+    chunks = format_message(anomalies, y_iso)
+    message = "\n".join(chunks)
     logging.info("Anomalies detected:\n%s", message)
 
-    posted = post_to_slack(message)
-    if CREATE_ISSUE:
-        title = f"[Cost Anomaly] {len(anomalies)} anomaly(s) on {yesterday.isoformat()}"
-        body = message + "\n\nDetected by automated job."
-        created = create_github_issue(title, body)
-        if not created:
-            logging.warning("Issue creation requested but failed.")
+    # One client for both POSTs: TCP+TLS setup happens once per host and the
+    # Slack and GitHub calls run concurrently instead of back to back.
+    async with httpx.AsyncClient(
+        timeout=10, transport=httpx.AsyncHTTPTransport(retries=3)
+    ) as client:
+        tasks = [post_to_slack(client, chunks)]
+        if CREATE_ISSUE:
+            title = f"[Cost Anomaly] {len(anomalies)} anomaly(s) on {y_iso}"
+            body = message + "\n\nDetected by automated job."
+            tasks.append(create_github_issue(client, title, body))
+        results = await asyncio.gather(*tasks)
+
+    if CREATE_ISSUE and not results[1]:
+        logging.warning("Issue creation requested but failed.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Detect GCP cost anomalies from BigQuery billing export.")
+    parser.add_argument("--test", action="store_true",
+                        help="format a sample report without querying BigQuery or posting anywhere")
+    args = parser.parse_args()
+    asyncio.run(main(test=args.test))